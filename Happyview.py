@@ -1,15 +1,25 @@
 from PyQt5.QtCore import (Qt, QRectF, QObject, pyqtSignal, QThread,
-						  QPointF, QSizeF, QTimeLine, QPoint, QTimer, QEvent)
+						  QPointF, QSizeF, QTimeLine, QPoint, QTimer, QEvent, QSize)
 from PyQt5.QtGui import (QBrush, QColor, QPixmap, QPainter, QTransform, QCursor, QMovie,
-						 QPalette)
+						 QPalette, QImage, QImageReader)
 from PyQt5.QtWidgets import (QGraphicsView, QGraphicsScene, QGraphicsLayoutItem,
 							 QGraphicsItem, QGraphicsLinearLayout, QGraphicsWidget,
-							 QGraphicsPixmapItem, QLabel, QMenu, QWidget, QFormLayout)
+							 QGraphicsPixmapItem, QGraphicsItemGroup, QGraphicsProxyWidget, QLabel, QMenu, QWidget, QFormLayout)
+
+from concurrent.futures import ThreadPoolExecutor
 
 import controls
 import math
 import subprocess
 import enum
+import os
+import sys
+import time
+import argparse
+import collections
+
+# supported extensions
+supportedExtensions = [".jpg", ".jpeg", ".png", ".bmp", ".gif"]
 
 class ReadingDirection(enum.Enum):
 	LeftToRight = 0
@@ -21,12 +31,33 @@ class ImageMode(enum.IntEnum):
 	FitWidth = 2
 	FitHeight = 3
 
+class ExportMode(enum.Enum):
+	ContactSheet = 0
+	Resize = 1
+
+def readImage(path, maxSize=None):
+	"""Decodes an image, safe to use outside the gui thread
+
+	params:
+		path - image path
+		maxSize - QSize, if given big images are decoded scaled down to fit inside it
+	"""
+	reader = QImageReader(path)
+	if maxSize is not None:
+		size = reader.size() # read from the header, nothing is decoded yet
+		if size.isValid() and (size.width() > maxSize.width() or size.height() > maxSize.height()):
+			# lets the decoder skip work, jpeg is decoded directly at the smaller size
+			reader.setScaledSize(size.scaled(maxSize, Qt.KeepAspectRatio))
+	return reader.read()
+
 class Gallery(QObject):
 	"""Represents and manages a list of images
 
 	When next or previous are loaded <ImageLoaded> signal is emitted with (item, path)
+	In spread mode <SpreadLoaded> is emitted instead with one or two (item, path) in page order
 	"""
 	imageLoaded = pyqtSignal(tuple)
+	spreadLoaded = pyqtSignal(tuple)
 
 	def __init__(self):
 		super().__init__()
@@ -35,20 +66,38 @@ class Gallery(QObject):
 		self._currentIdx = -1
 		self._loadCount = 2 # amount of images to keep loaded
 
+		self._spread = False
+		self._spreadLength = 0 # pages in the current spread, starting at _currentIdx
+		self._spreadBefore = {} # first page of a spread: first page of the spread shown before it
+		self._shownPages = [] # pages of the spread shown before the current one
+		self._spreadLoaded = set() # pages loaded in spread mode, unloaded a spread at a time
+		self._wide = {} # idx: if the image is wider than high, read from the header when needed
+		self._pool = ThreadPoolExecutor(2) # decodes both pages of a spread at the same time
+		self._prefetched = {} # idx: future with the decoded QImage
+
 	def first(self):
 		"Loads first image"
-		if self._images:
+		if self._spread:
+			self._loadSpread(self._spreadFrom(0))
+		elif self._images:
 			self._currentIdx = 0
 			self.imageLoaded.emit(self._getImage(self._currentIdx))
 
 	def last(self):
 		"Loads last image"
-		if self._images:
+		if self._spread:
+			if self._images:
+				self._loadSpread(self._spreadEndingAt(len(self._images)-1))
+		elif self._images:
 			self._currentIdx = len(self._images)-1
 			self.imageLoaded.emit(self._getImage(self._currentIdx))
 
 	def prevImage(self):
 		"Loads prev image"
+		if self._spread:
+			if self._currentIdx > 0:
+				self._loadSpread(self._prevSpread(self._currentIdx))
+			return
 		nextIdx = max(0, self._currentIdx-1) # to avoid going below 0
 		img = self._getImage(nextIdx)
 		if img:
@@ -57,6 +106,13 @@ class Gallery(QObject):
 
 	def nextImage(self):
 		"Loads next image"
+		if self._spread:
+			start = max(0, self._currentIdx+self._spreadLength)
+			if start < len(self._images):
+				if self._spreadLength:
+					self._spreadBefore[start] = self._currentIdx
+				self._loadSpread(self._spreadFrom(start))
+			return
 		img = self._getImage(self._currentIdx+1)
 		if img:
 			self._currentIdx += 1
@@ -74,18 +130,24 @@ class Gallery(QObject):
 					i.setMovie(m)
 					m.start()
 				else:
-					i = QGraphicsPixmapItem(QPixmap(img))
+					if idx in self._prefetched:
+						image = self._prefetched.pop(idx).result()
+					else:
+						image = readImage(img)
+					i = QGraphicsPixmapItem(QPixmap.fromImage(image))
 					i.setTransformationMode(Qt.SmoothTransformation)
 				self._images[idx] = (i, img,)
 				img = self._images[idx]
 
 			# only keep x amounts of items loaded by unloading everything before
-			try:
-				prevItem = self._images[idx-self._loadCount]
-				if isinstance(prevItem, tuple):
-					self._images[idx-self._loadCount] = prevItem[1]
-			except IndexError:
-				pass
+			# spreads are unloaded by _loadSpread
+			if not self._spread:
+				try:
+					prevItem = self._images[idx-self._loadCount]
+					if isinstance(prevItem, tuple):
+						self._images[idx-self._loadCount] = prevItem[1]
+				except IndexError:
+					pass
 
 			return img
 		except IndexError:
@@ -94,17 +156,216 @@ class Gallery(QObject):
 	def addImages(self, paths):
 		self._images.extend(paths)
 
+	def setSpread(self, spread):
+		"Show two pages at a time, wide pages are still shown alone"
+		if spread == self._spread:
+			return
+		self._spread = spread
+		if self._currentIdx < 0: # nothing shown yet
+			return
+		if spread:
+			self._loadSpread(self._spreadFrom(self._currentIdx)) # the current page starts the spread
+		else:
+			self._spreadLength = 0
+			self._shownPages = []
+			self._unloadSpreads([self._currentIdx])
+			img = self._getImage(self._currentIdx)
+			if img:
+				self.imageLoaded.emit(img)
+
+	def close(self):
+		"Stops background decoding"
+		self._prefetch([])
+		self._pool.shutdown(wait=False)
+
+	def _loadSpread(self, pages):
+		"Loads the pages of a spread and prefetches the spreads next to it"
+		self._prefetch(pages) # so both pages are decoded at the same time
+		items = tuple(self._getImage(i) for i in pages)
+		backwards = self._spreadLength and pages[0] < self._currentIdx
+		if self._spreadLength:
+			self._shownPages = list(range(self._currentIdx, self._currentIdx+self._spreadLength))
+		self._currentIdx = pages[0]
+		self._spreadLength = len(pages)
+		self._spreadLoaded.update(pages)
+		# the spread turned away from stays loaded, so turning back to it is free
+		self._unloadSpreads(pages+self._shownPages)
+		self.spreadLoaded.emit(items)
+
+		# the pairs on both sides are decoded while this one is looked at,
+		# the one in the direction we are going first
+		around = []
+		if pages[-1]+1 < len(self._images):
+			around.append(self._spreadFrom(pages[-1]+1))
+		if pages[0] > 0:
+			around.append(self._prevSpread(pages[0]))
+		if backwards:
+			around.reverse()
+		self._prefetch([i for p in around for i in p])
+
+	def _unloadSpreads(self, keep):
+		"Unloads the pages loaded in spread mode that aren't in keep"
+		for idx in self._spreadLoaded.difference(keep):
+			img = self._images[idx]
+			if isinstance(img, tuple):
+				self._images[idx] = img[1]
+		self._spreadLoaded.intersection_update(keep)
+
+	def _prevSpread(self, start):
+		"Returns the pages of the spread before the one starting at start"
+		prevStart = self._spreadBefore.get(start)
+		if prevStart is None:
+			return self._spreadEndingAt(start-1)
+		return self._spreadFrom(prevStart)
+
+	def _spreadFrom(self, start):
+		"Returns the pages of the spread starting at start, wide pages and the page before one are shown alone"
+		if start+1 < len(self._images) and not self._isWide(start) and not self._isWide(start+1):
+			return [start, start+1]
+		return [start]
+
+	def _spreadEndingAt(self, end):
+		"Returns the pages of the spread ending at end, for going backwards"
+		if end > 0 and not self._isWide(end) and not self._isWide(end-1):
+			return [end-1, end]
+		return [end]
+
+	def _isWide(self, idx):
+		"Only reads the image header"
+		if idx not in self._wide:
+			img = self._images[idx]
+			if isinstance(img, tuple):
+				img = img[1]
+			size = QImageReader(img).size()
+			self._wide[idx] = size.width() > size.height()
+		return self._wide[idx]
+
+	def _prefetch(self, indexes):
+		"Starts decoding the images at indexes in the background, older prefetches are dropped"
+		prefetched = {}
+		for idx in indexes:
+			img = self._images[idx]
+			if idx in self._prefetched:
+				prefetched[idx] = self._prefetched.pop(idx)
+			elif not isinstance(img, tuple) and not img.endswith((".gif",)):
+				prefetched[idx] = self._pool.submit(readImage, img)
+		for f in self._prefetched.values():
+			f.cancel()
+		self._prefetched = prefetched
+
+class SameFolderError(Exception):
+	"Raised when an export would write into the folder it reads from"
+
+class Exporter:
+	"""Exports images as contact sheets or resized copies without showing a window
+
+	Images are decoded scaled down on a pool of threads and written out as they
+	come in, so only a few images are in memory no matter how many there are.
+	"""
+
+	def __init__(self, outDir, mode=ExportMode.ContactSheet, tileSize=256,
+			  columns=6, rows=5, workers=None):
+		assert tileSize > 0 and columns > 0 and rows > 0
+		assert workers is None or workers > 0
+		self._outDir = outDir
+		self._mode = mode
+		self._tileSize = QSize(tileSize, tileSize)
+		self._columns = columns
+		self._rows = rows
+		self._workers = workers or os.cpu_count() or 1
+		self._backgroundColor = QColor("#404244")
+
+		self._sheet = None
+		self._sheetCount = 0
+		self._tileCount = 0 # tiles on the current sheet
+		self._exported = 0
+		self._failed = 0 # images that couldn't be read or written
+
+	def run(self, sources):
+		"""Exports all sources in order
+
+		Raises SameFolderError if outDir is a folder the sources are in, so they are never overwritten
+		Returns (images exported, images failed, seconds used)
+		"""
+		sources = list(sources)
+		if os.path.isdir(self._outDir):
+			for folder in {os.path.dirname(x) or "." for x in sources}:
+				if os.path.samefile(self._outDir, folder):
+					raise SameFolderError("Output folder can't be the same as the source folder: {}".format(folder))
+		os.makedirs(self._outDir, exist_ok=True)
+
+		self._exported = self._failed = 0
+		start = time.perf_counter()
+		# only keep a couple of images per worker in flight to bound memory
+		pending = collections.deque()
+		with ThreadPoolExecutor(self._workers) as pool:
+			for path in sources:
+				pending.append(pool.submit(self._decode, path))
+				if len(pending) >= self._workers*2:
+					self._collect(pending.popleft().result())
+			while pending:
+				self._collect(pending.popleft().result())
+		self._writeSheet()
+		return self._exported, self._failed, time.perf_counter()-start
+
+	def _decode(self, path):
+		"Runs in a worker thread, returns None if the image failed"
+		img = readImage(path, self._tileSize)
+		if img.isNull():
+			return None
+		if self._mode == ExportMode.Resize:
+			name = os.path.split(path)[1]
+			if name.endswith(".gif"): # qt can't write gifs
+				name += ".png"
+			if not img.save(os.path.join(self._outDir, name)):
+				return None
+			return True
+		return img
+
+	def _collect(self, result):
+		if result is None:
+			self._failed += 1
+		elif self._mode == ExportMode.ContactSheet:
+			self._addTile(result) # counted when the sheet is written
+		else:
+			self._exported += 1
+
+	def _addTile(self, img):
+		"Paints the image centered in the next free tile"
+		w, h = self._tileSize.width(), self._tileSize.height()
+		if not self._sheet:
+			self._sheet = QImage(w*self._columns, h*self._rows, QImage.Format_RGB32)
+			self._sheet.fill(self._backgroundColor)
+
+		x = (self._tileCount % self._columns)*w + (w-img.width())//2
+		y = (self._tileCount // self._columns)*h + (h-img.height())//2
+		painter = QPainter(self._sheet)
+		painter.drawImage(x, y, img)
+		painter.end()
+
+		self._tileCount += 1
+		if self._tileCount == self._columns*self._rows:
+			self._writeSheet()
+
+	def _writeSheet(self):
+		if self._sheet:
+			self._sheetCount += 1
+			if self._sheet.save(os.path.join(self._outDir, "sheet_{:04d}.jpg".format(self._sheetCount))):
+				self._exported += self._tileCount
+			else:
+				self._failed += self._tileCount
+			self._sheet = None
+			self._tileCount = 0
+
 class Happyview(QGraphicsView):
 	""
 
 	def __init__(self):
 		super().__init__()
 
-		# supported extensions
-		suppExtensions = [".jpg", ".jpeg", ".png", ".bmp", ".gif"]
-
 		self._orientation = Qt.Vertical # which way to go for the next image
 		self._readingDirection = ReadingDirection.LeftToRight
+		self._spread = False # show two pages side by side
 		self._imageMode = None
 		self._backgroundColor = "#404244"
 		self._backgroundBrush = QBrush(QColor(self._backgroundColor))
@@ -126,11 +387,12 @@ class Happyview(QGraphicsView):
 		self._mainScene.setBackgroundBrush(self._backgroundBrush)
 
 		# init controls
-		self._mainControls = controls.MainControls(suppExtensions, self)
+		self._mainControls = controls.MainControls(supportedExtensions, self)
 		self._navControls = controls.NavControls(self)
 
 		self._currentGallery = None
 		self._currentItem = None
+		self._currentPages = None # (item, path) of each page when a spread is shown
 
 		# image info widget
 		self._imageInfo = QWidget(self)
@@ -236,14 +498,29 @@ class Happyview(QGraphicsView):
 		assert isinstance(g, Gallery)
 		if self._currentGallery:
 			self._currentGallery.imageLoaded.disconnect()
-		if self._currentItem:
-			self._mainScene.removeItem(self._currentItem)
-			self._currentItem = None
+			self._currentGallery.spreadLoaded.disconnect()
+			self._currentGallery.close()
+		self._clearItems()
 
 		self._currentGallery = g
 		g.imageLoaded.connect(self._setItem)
+		g.spreadLoaded.connect(self._setSpread)
+		g.setSpread(self._spread)
 		self.requestNext()
 
+	def toggleSpread(self):
+		"Show one or two pages at a time"
+		self._spread = not self._spread
+		if self._currentGallery:
+			self._currentGallery.setSpread(self._spread)
+
+	def setReadingDirection(self, direction):
+		"Which way the pages of a spread are read"
+		assert isinstance(direction, ReadingDirection)
+		self._readingDirection = direction
+		if self._currentPages:
+			self._setSpread(self._currentPages) # lay out the current spread again
+
 	def setScalingFactor(self, f):
 		"How much to zoom on each click"
 		self._scalingFactor = f
@@ -292,20 +569,66 @@ class Happyview(QGraphicsView):
 
 	def _setItem(self, itemtuple):
 		"Recieves a QGraphicsPixmapItem by the Gallery class"
-		if self._currentItem:
-			self._mainScene.removeItem(self._currentItem)
+		self._clearItems()
 		if itemtuple:
-			item = itemtuple[0]
-			if isinstance(item, QLabel):
-				self._currentItem = self._mainScene.addWidget(item)
-			else:
-				self._mainScene.addItem(item)
-				self._currentItem = item
+			self._currentItem = self._addToScene(itemtuple[0])
 			path = itemtuple[1]
 			self._imageName.setText(os.path.splitext(os.path.split(path)[1])[0]) # get last part of path and remove extension
 			self._imagePath.setText(path)
 		self.updateView()
 
+	def _setSpread(self, itemtuples):
+		"Recieves the pages of a spread by the Gallery class and places them side by side"
+		self._clearItems()
+		if itemtuples:
+			pages = [self._addToScene(t[0]) for t in itemtuples]
+			if self._readingDirection == ReadingDirection.RightToLeft:
+				pages.reverse()
+			# vertically centered next to each other
+			height = max(p.boundingRect().height() for p in pages)
+			x = 0
+			for p in pages:
+				rect = p.boundingRect()
+				p.setPos(x, (height-rect.height())/2)
+				x += rect.width()
+			self._currentItem = self._mainScene.createItemGroup(pages)
+			self._currentPages = itemtuples
+			self._imageName.setText(" | ".join(os.path.splitext(os.path.split(t[1])[1])[0] for t in itemtuples))
+			self._imagePath.setText(itemtuples[0][1])
+		self.updateView()
+
+	def _addToScene(self, item):
+		"Adds an item from the Gallery class to the scene"
+		if isinstance(item, QLabel):
+			# a label that was shown before can still have its proxy
+			item = item.graphicsProxyWidget() or self._mainScene.addWidget(item)
+			item.show() # the label was hidden when it was last removed
+		item.setPos(0, 0) # might have been part of a spread
+		if item.scene() is not self._mainScene:
+			self._mainScene.addItem(item)
+		return item
+
+	def _removeFromScene(self, item):
+		if isinstance(item, QGraphicsProxyWidget):
+			# the Gallery keeps the label, so it must not be deleted along with the proxy
+			label = item.widget()
+			item.setWidget(None)
+			label.hide() # or it would show up as a window of its own
+		self._mainScene.removeItem(item)
+
+	def _clearItems(self):
+		"Removes the current image or spread from the scene"
+		if self._currentItem:
+			if isinstance(self._currentItem, QGraphicsItemGroup):
+				pages = self._currentItem.childItems()
+				self._mainScene.destroyItemGroup(self._currentItem)
+				for p in pages:
+					self._removeFromScene(p)
+			else:
+				self._removeFromScene(self._currentItem)
+			self._currentItem = None
+			self._currentPages = None
+
 	def _startZoom(self, _in):
 		self._zoomIn = _in
 		if self._zoomAnimation.Running:
@@ -345,6 +668,11 @@ class Happyview(QGraphicsView):
 		if self._currentItem:
 			menu = QMenu(self)
 			menu.addAction("Toggle image info", lambda: self._imageInfo.hide() if self._imageInfo.isVisible() else self._imageInfo.show())
+			menu.addAction("Toggle two-page spread", self.toggleSpread)
+			if self._readingDirection == ReadingDirection.LeftToRight:
+				menu.addAction("Read right to left", lambda: self.setReadingDirection(ReadingDirection.RightToLeft))
+			else:
+				menu.addAction("Read left to right", lambda: self.setReadingDirection(ReadingDirection.LeftToRight))
 			menu.addAction("Show in explorer", lambda: subprocess.Popen(r'explorer.exe /select,"{}"'.format(os.path.normcase(self._imagePath.text())), shell=True))
 			menu.exec(ev.globalPos())
 			ev.accept()
@@ -402,9 +730,68 @@ class Happyview(QGraphicsView):
 		self.toggleFullscreen()
 		return super().mouseDoubleClickEvent(ev)
 
+def gridSize(text):
+	"Parses columns x rows like 6x5"
+	try:
+		columns, rows = (int(x) for x in text.lower().split("x"))
+	except ValueError:
+		raise argparse.ArgumentTypeError("expected columns x rows like 6x5, got {!r}".format(text))
+	if columns < 1 or rows < 1:
+		raise argparse.ArgumentTypeError("columns and rows must be at least 1, got {!r}".format(text))
+	return columns, rows
+
+def positiveInt(text):
+	"Parses a whole number of at least 1"
+	try:
+		value = int(text)
+	except ValueError:
+		raise argparse.ArgumentTypeError("expected a whole number, got {!r}".format(text))
+	if value < 1:
+		raise argparse.ArgumentTypeError("must be at least 1, got {!r}".format(text))
+	return value
+
+def existingFolder(text):
+	"An existing folder"
+	if not os.path.isdir(text):
+		raise argparse.ArgumentTypeError("not a folder: {!r}".format(text))
+	return text
+
+def exportFolder(args):
+	"Headless mode, no window is shown"
+	from PyQt5.QtGui import QGuiApplication
+
+	os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+	app = QGuiApplication(sys.argv[:1]) # needed for the image plugins
+
+	columns, rows = args.grid
+	mode = ExportMode.Resize if args.resize else ExportMode.ContactSheet
+	exporter = Exporter(args.out, mode, args.size, columns, rows, args.workers)
+	try:
+		count, failed, secs = exporter.run(controls.scanFolder(args.export, supportedExtensions))
+	except SameFolderError as e:
+		print(e, file=sys.stderr)
+		return 1
+	print("Exported {} images in {:.2f} secs ({:.1f} images/sec)".format(
+		count, secs, count/max(secs, 1e-9)))
+	if failed:
+		print("{} images failed".format(failed), file=sys.stderr)
+		return 1
+	return 0
+
 if __name__ == '__main__':
 	from PyQt5.QtWidgets import QApplication
-	import os, sys
+
+	parser = argparse.ArgumentParser(description="Happyview")
+	parser.add_argument("--export", type=existingFolder, metavar="FOLDER", help="export FOLDER without showing a window")
+	parser.add_argument("--out", default="export", help="where to write exported images")
+	parser.add_argument("--resize", action="store_true", help="write resized copies instead of contact sheets")
+	parser.add_argument("--size", type=positiveInt, default=256, help="max width and height of each image")
+	parser.add_argument("--grid", type=gridSize, default="6x5", help="contact sheet columns x rows")
+	parser.add_argument("--workers", type=positiveInt, help="decoding threads, defaults to core count")
+	args, _ = parser.parse_known_args()
+
+	if args.export:
+		sys.exit(exportFolder(args))
 
 	app = QApplication(sys.argv)
 	view = Happyview()
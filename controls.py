@@ -8,6 +8,10 @@ from PyQt5.QtWidgets import (QToolBar, QPushButton, QFileDialog, QWidget,
 
 import os
 
+def scanFolder(folder, exts):
+	"Returns paths of the images in folder with a supported extension"
+	return [os.path.join(folder, x) for x in os.listdir(folder) if x.endswith(tuple(exts))]
+
 class Direction(Enum):
 	Forward = 0
 	Backward = 1
@@ -116,8 +120,7 @@ class MainControls(BaseControl):
 		"Load images from a folder"
 		folder = QFileDialog.getExistingDirectory(self.parentWidget(), "Choose folder")
 		if folder:
-			self.imagesSelected.emit(
-				[os.path.join(folder, x) for x in os.listdir(folder) if x.endswith(tuple(self.supportedExts))])
+			self.imagesSelected.emit(scanFolder(folder, self.supportedExts))
 
 	def chooseFile(self):
 		"Load a single image"